@@ -4,85 +4,217 @@ E-mail: matthewjdarling@gmail.com
 Provides methods to get results from the Oracle of Objects website for the odds of co-ocurrence of objects,
 as well as the items that would most likely be in an image with a queried object.
 
-Uses the helper method strip_html to clean up the HTML version of the site downloaded through the urllib.urlopen() method.
+Uses the helper method strip_html to clean up the HTML version of the site, before the answers are parsed by precompiled regular expressions.
 
-proximity('dog') will return a dictionary of object: probability containing the ten objects most likely to be in an image with a dog in a random order.
+proximity('dog') will return a dictionary of object: probability containing the objects most likely to be in an image with a dog, usually ten of them.
+proximity_ranking('dog') returns the same answers as a list of (object, probability) pairs, most likely first, however many the website gives.
+
+coocurrence(['bone','house'],'dog') will return a float for the probability of finding all the facts, as many as needed, in an image with a dog.
 
 coocurrence1('bone','dog) will return a float for the probability of finding a bone in an image with a dog.
 
 Likewise, coocurrence2('bone','house','dog') will return a float for the probability of finding both a bone and a house in an image with a dog.
 
-coocurrence3('bone','house','child','dog') returns a float for the probability of finding a bone, a house and a child in an image with a dog."""
+coocurrence3('bone','house','child','dog') returns a float for the probability of finding a bone, a house and a child in an image with a dog.
+
+The answers of the website are kept in a local SQLite file (cache_file), so that a question asked again within cache_ttl seconds doesn't go through the network.
+The file keeps at most cache_max_entries answers, dropping the oldest ones first. Set caching to False to always ask the website.
+The answers are kept as read from the pages, so that a question found in the cache isn't parsed again, and only when an answer could be read. Questions are sent as they are written, but are lowercased and stripped to be looked up in the cache.
+
+coocurrence_many([('bone','dog'), ('bone','house','dog')]) asks many questions at once, over oracle_workers threads, and returns a list of floats in the same order.
+Each question is a tuple of the facts followed by the query.
+The connections to the website are kept open between questions, with at most host_connections of them at once, and failed questions are asked again up to retries times.
+Changing host_connections, retries or backoff takes effect from the next question."""
 
+import os
+import sys
+import time
+import sqlite3
+import json
+import threading
 import urllib
 import re
 
-def strip_html(value):
-    """Takes and returns a string and strips the HTML tags stripped. 
+import connections
+
+###### Variables ######
+
+cooccurrence_url = "http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/action.php"
+proximity_url = "http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/proximity-action.php"
+
+caching = True
+cache_file = os.path.join(os.path.dirname(sys.argv[0]), "oracle_cache.sqlite")
+# Answers older than this many seconds are asked again
+cache_ttl = 30*24*3600
+cache_max_entries = 100000
+
+# Threads asking the questions of coocurrence_many
+oracle_workers = 8
+host_connections = 4
+retries = 3
+# Seconds to wait before asking a failed question again, doubled at each new try
+backoff = 0.5
+
+#######################
+
+cache = [None]
+# The cache file is shared by the threads of coocurrence_many
+cache_lock = threading.RLock()
+# The connection pool and the variables it was made with, made again when they change
+pool = [None, None]
+pool_lock = threading.Lock()
+
+def connection_pool():
+    """Returns the pool of connections to the website, following the current values of host_connections, retries and backoff"""
+    settings = (host_connections, retries, backoff)
+    with pool_lock:
+        if pool[1] != settings:
+            if pool[0] is not None:
+                pool[0].close()
+            pool[0] = connections.ConnectionPool(*settings)
+            pool[1] = settings
+        return pool[0]
+
+def open_cache():
+    """Opens the cache file, creating it if needed"""
+    if cache[0] is None:
+        connection = sqlite3.connect(cache_file, check_same_thread=False)
+        connection.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer TEXT, stored REAL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS answers_stored ON answers (stored)")
+        connection.commit()
+        cache[0] = connection
+    return cache[0]
+
+def clear_cache():
+    """Forgets all answers kept in the cache file"""
+    with cache_lock:
+        connection = open_cache()
+        connection.execute("DELETE FROM answers")
+        connection.commit()
+
+def normalize(params):
+    """Lowercases and strips the values of a question, so that the same question always has the same key in the cache"""
+    return dict((name, value.strip().lower()) for name, value in params.iteritems())
+
+def cache_key(url, params):
+    """Returns the key of a question in the cache: the address and the sorted normalized parameters"""
+    return url+"?"+urllib.urlencode(sorted(normalize(params).items()))
+
+def ask(url, params, parse):
+    """Posts a question to the Oracle of Objects and returns the answer read from its page by parse, taken from the cache if it was asked recently.
+    
+    The answer is kept in the cache as JSON, and only when parse could read it, parse raising ValueError otherwise."""
+    key = cache_key(url, params)
+    if caching:
+        with cache_lock:
+            connection = open_cache()
+            row = connection.execute("SELECT answer, stored FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is not None and time.time()-row[1] < cache_ttl:
+            return json.loads(row[0])
+
+    tempparams = dict(params)
+    tempparams['submitform'] = 'Ask the Oracle &raquo;'
+    page = connection_pool().request("POST", url, urllib.urlencode(tempparams), {"Content-Type": "application/x-www-form-urlencoded"})
+    answer = parse(page)
+
+    if caching:
+        with cache_lock:
+            now = time.time()
+            connection.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)", (key, json.dumps(answer), now))
+            connection.execute("DELETE FROM answers WHERE stored < ?", (now-cache_ttl,))
+            excess = connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]-cache_max_entries
+            if excess > 0:
+                connection.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY stored LIMIT ?)", (excess,))
+            connection.commit()
+    return answer
+
+html_tag = re.compile(r'<[^>]*?>')
+html_margin = re.compile(r'2em\s1em\s1em\s1em')
+html_step = re.compile(r'Step\s\d')
+coocurrence_answer = re.compile(r'\d\.\d*')
+# An object name followed by a probability written with decimals, so that text such as "Top 10 objects" isn't taken for an answer
+proximity_answer = re.compile(r'\b([A-Za-z]\w*)\s+(\d\.\d+)\b')
+
+def strip_html(value, separator=''):
+    """Takes and returns a string and strips the HTML tags stripped, replaced by separator. 
     
     Also removes some potential problems from the string."""
-    value = re.sub(r'<[^>]*?>', '', value)
-    value = re.sub(r'2em\s1em\s1em\s1em', '', value)
-    value = re.sub(r'Step\s\d', '', value)
+    value = html_tag.sub(separator, value)
+    value = html_margin.sub('', value)
+    value = html_step.sub('', value)
     return value
 
+def coocurrence_params(facts, query):
+    """Returns the form of a question to the Oracle: fact1 to factN and the query"""
+    params = dict(('fact'+str(number), fact) for number, fact in enumerate(facts, 1))
+    params['query'] = query
+    return params
+
+def parse_coocurrence(page):
+    """Returns the odds of co-ocurrence found in a page of the Oracle as a float"""
+    answer = coocurrence_answer.search(strip_html(page))
+    if answer is None:
+        raise ValueError("No odds of co-ocurrence in the answer of the Oracle")
+    return float(answer.group())
+
+def parse_proximity(page):
+    """Returns the (object, probability) pairs found in a proximity page of the Oracle, most likely first"""
+    ranking = [(name, float(probability)) for name, probability in proximity_answer.findall(strip_html(page, ' '))]
+    ranking = [(name, probability) for name, probability in ranking if probability <= 1.0]
+    if not ranking:
+        raise ValueError("No objects in the proximity answer of the Oracle")
+    ranking.sort(key=lambda pair: pair[1], reverse=True)
+    return ranking
+
+def coocurrence(facts, query):
+    """Takes a list of facts and query as strings and calculates the odds of all the facts appearing in an image with query.
+    
+    Returns the odds of co-ocurrence as a float."""
+    return ask(cooccurrence_url, coocurrence_params(facts, query), parse_coocurrence)
+
 def coocurrence1(fact1, query):
     """Takes fact1, query as strings and calculates the odds of fact1 appearing in an image with query.
     
     Returns the odds of co-ocurrence as a float."""
-    tempparams = urllib.urlencode({'fact1': fact1, 'query': query, 'submitform': 'Ask the Oracle &raquo;'})
-    temppage = urllib.urlopen("http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/action.php", tempparams)
-    tempstring = ''
-    tempstring = tempstring + temppage.read()
-    tempstring = strip_html(tempstring)
-    foundAnswer = re.compile('\d\.\d*')
-    tempAnswer = foundAnswer.search(tempstring)
-    answer = '' + tempAnswer.group()
-    answer = float(answer)
-    return answer
+    return coocurrence([fact1], query)
 
 def coocurrence2(fact1, fact2, query):
     """Takes fact1, fact2, query as strings and calculates the odds of fact 1 and fact2 appearing in an image with query.
     
     Returns the odds of co-ocurrence as a float."""
-    tempparams = urllib.urlencode({'fact1': fact1, 'fact2': fact2, 'query':query, 'submitform': 'Ask the Oracle &raquo;'})
-    temppage = urllib.urlopen("http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/action.php", tempparams)
-    tempstring = ''
-    tempstring = tempstring + temppage.read()
-    tempstring = strip_html(tempstring)
-    foundAnswer = re.compile('\d\.\d*')
-    tempAnswer = foundAnswer.search(tempstring)
-    answer = '' + tempAnswer.group()
-    answer = float(answer)
-    return answer
-
+    return coocurrence([fact1, fact2], query)
 
 def coocurrence3(fact1,fact2,fact3,query):
     """Takes fact1, fact2, fact3, query as strings and calculates the odds of fact1, fact2, and fact3 appearing in an image with query.
     
     Returns the odds of co-ocurrence as a float."""
-    tempparams = urllib.urlencode({'fact1': fact1, 'fact2': fact2, 'fact3': fact3, 'query':query, 'submitform': 'Ask the Oracle &raquo;'})
-    temppage = urllib.urlopen("http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/action.php", tempparams)
-    tempstring = ''
-    tempstring = tempstring + temppage.read()
-    tempstring = strip_html(tempstring)
-    foundAnswer = re.compile('\d\.\d*')
-    tempAnswer = foundAnswer.search(tempstring)
-    answer = '' + tempAnswer.group()
-    answer = float(answer)
-    return answer
+    return coocurrence([fact1, fact2, fact3], query)
 
+def coocurrence_question(question):
+    """Asks a single question of coocurrence_many: the facts followed by the query"""
+    if len(question) < 2:
+        raise ValueError("A question needs at least one fact and a query: "+repr(question))
+    return coocurrence(question[:-1], question[-1])
+
+def coocurrence_many(questions, workers=None):
+    """Takes a list of questions, each a tuple of facts followed by the query, and asks them concurrently.
+    
+    Returns the odds of co-ocurrence as a list of floats, in the order of the questions."""
+    if workers is None:
+        workers = oracle_workers
+    return connections.map_concurrently(coocurrence_question, [tuple(question) for question in questions], workers)
+
+def proximity_ranking(query):
+    """Takes query as a string and returns a list of (object, probability) pairs of the objects most likely to be found in a picture with query, most likely first.
+    
+    Returns an empty list when the website gives no objects."""
+    try:
+        ranking = ask(proximity_url, {'query': query}, parse_proximity)
+    except ValueError:
+        return []
+    # The pairs come back from the cache as lists of unicode names
+    return [(str(name), probability) for name, probability in ranking]
 
 def proximity(query):
-    "Takes query as a string and returns a dictionary of object: probability representing the ten most likely objects to find in a picture with query, and the probability of finding each of them."
-    tempparams = urllib.urlencode({'query': query, 'submitform': 'Ask the Oracle &raquo;'})
-    temppage = urllib.urlopen("http://ing.utalca.cl/~castudillo/research/pkb/co_ocurrence/proximity-action.php", tempparams)
-    tempstring = ''
-    tempstring = tempstring + temppage.read()
-    tempstring = strip_html(tempstring)
-    foundAnswer = re.compile('\w*\s\d.*\d*')
-    tempAnswer = foundAnswer.findall(tempstring)
-    stringAnswer = '\n'.join(tempAnswer)
-    tempDict = re.split('\s', stringAnswer)
-    dict = {tempDict[0]:tempDict[1], tempDict[2]:tempDict[3], tempDict[4]:tempDict[5], tempDict[6]:tempDict[7], tempDict[8]:tempDict[9], tempDict[10]:tempDict[11], tempDict[12]:tempDict[13], tempDict[14]:tempDict[15], tempDict[16]:tempDict[17], tempDict[18]:tempDict[19]}
-    return dict
+    "Takes query as a string and returns a dictionary of object: probability representing the most likely objects to find in a picture with query, and the probability of finding each of them."
+    return dict(proximity_ranking(query))
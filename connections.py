@@ -0,0 +1,140 @@
+'''
+Created on 2026-10-18
+
+Sends HTTP requests over persistent connections, shared by many threads
+
+A ConnectionPool keeps the connections to each host open between requests, so that a series of requests
+to the same website doesn't pay for a new connection every time. At most host_limit requests are sent
+to a host at once, and at most rate requests per second overall when a rate is given.
+A request that fails because of the network or a server error is tried again after waiting backoff seconds,
+doubled at each new try, up to retries times. Redirections are followed, up to max_redirections of them.
+
+map_concurrently() runs a function over many items with a pool of threads and returns the results in order.
+
+Science of Imagination Laboratory
+'''
+
+import time
+import socket
+import threading
+import httplib
+import urlparse
+import multiprocessing.pool
+
+class RequestError(IOError):
+    """ A request that still failed after all its tries """
+    pass
+
+redirections = (301, 302, 303, 307)
+max_redirections = 5
+
+class ConnectionPool(object):
+    """ Persistent HTTP connections to many hosts, with a limit of simultaneous requests for each host """
+    def __init__(self, host_limit=4, retries=3, backoff=0.5, rate=None, timeout=60):
+        self.host_limit = host_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.next_request = 0.0
+
+    def slot(self, host):
+        """ Returns the semaphore limiting the simultaneous requests to a host """
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.host_limit)
+            return self.slots[host]
+
+    def connection(self, scheme, host):
+        """ Takes an idle connection to a host, or opens a new one """
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop()
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def release(self, scheme, host, connection):
+        """ Keeps a connection whose response was read entirely, for the next request to its host """
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(connection)
+
+    def wait_turn(self):
+        """ Waits until the rate limit allows another request """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request)
+            self.next_request = start + 1.0/self.rate
+        if start > now:
+            time.sleep(start-now)
+
+    def request(self, method, url, body=None, headers=None, redirected=0):
+        """ Sends a request and returns the body of the response, trying again if the network or the server fails """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = path+"?"+parts.query
+        headers = dict(headers or {})
+        slot = self.slot(parts.netloc)
+        attempt = 0
+        while True:
+            self.wait_turn()
+            slot.acquire()
+            connection = self.connection(parts.scheme, parts.netloc)
+            try:
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse(buffering=True)
+                    data = response.read()
+                except (socket.error, httplib.HTTPException), error:
+                    connection.close()
+                    problem = error
+                else:
+                    if response.will_close:
+                        connection.close()
+                    else:
+                        self.release(parts.scheme, parts.netloc, connection)
+                    location = response.getheader("location")
+                    if response.status in redirections and location and redirected < max_redirections:
+                        break
+                    if response.status < 400:
+                        return data
+                    problem = str(response.status)+" "+response.reason
+                    if response.status < 500:
+                        raise RequestError(url+": "+problem)
+            finally:
+                slot.release()
+            if attempt >= self.retries:
+                raise RequestError(url+": "+str(problem))
+            time.sleep(self.backoff*2**attempt)
+            attempt += 1
+        # Outside of the loop, so that the slot of the host is released before following the redirection
+        location = urlparse.urljoin(url, location)
+        if response.status == 303:
+            return self.request("GET", location, None, headers, redirected+1)
+        return self.request(method, location, body, headers, redirected+1)
+
+    def close(self):
+        """ Closes all the idle connections """
+        with self.lock:
+            for connections in self.idle.itervalues():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+def map_concurrently(function, items, workers):
+    """ Applies a function to every item with a pool of threads, and returns the results in the order of the items """
+    if workers <= 1:
+        return [function(item) for item in items]
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        return pool.map(function, items, 1)
+    finally:
+        pool.close()
+        pool.join()
@@ -8,6 +8,7 @@ If you don't have a dataset, run the main method from labelmeretriever.
 To do the first time you use a dataset from LabelMe:
 Run the main method from xmlindexer. The data folder should be in the same folder as the xmlindexer and display script.
 It will create an index file inside the data folder, which will then be used to search for objects.
+The index is read once and kept in memory. After indexing the data folder again, write "object_index.reload()"
 
 One way to use the script:
 1. Open a command prompt inside the folder in which the script is placed.
@@ -15,6 +16,7 @@ One way to use the script:
 3. Write "imagine('the_object_to_be_displayed', (x,y))" where x and y are values between 0 and 1.
 4. A window will appear displaying the object. Close it with either the Escape key or the Close button to summon another object.
 5. The objects are kept in memory. If you want to reset the screen, write "clear()"
+6. To keep the window open between objects, write "start_viewer()" first. imagine() then returns right away and the window shows each new object. "stop_viewer()" closes it.
 
 To display from a file:
 3. Write "display_from_file('filename')"
@@ -22,8 +24,20 @@ To display from a file:
 
 To use the Oracle of Objects:
 3. Write "proximity('the_object_to_be_displayed')"
+    Set local_oracle to True in the parameters to compute the answers from the data folder instead of asking the website.
+
+To compose objects without opening a window, for instance on a server:
+3. Write "imagine('the_object_to_be_displayed', (x,y), draw=False)" for each object
+4. Write "render('scene.png')" to save the scene as an image. render() also returns the scene as a surface, or as an array with render(as_array=True)
+
+To render many scene files to images, without opening a window:
+3. Write "render_scenes('scenes_folder', 'output_folder')", or give a list of scene files instead of a folder.
+    Each scene is saved as a PNG image named after its file. The objects displayed so far are cleared.
+    Add workers=N to cut the objects out of their pictures with N processes, scene_batch scenes at a time.
+    Likewise, "imagine_many([('car', (x,y)), ('tree', (x,y))], workers=N)" imagines many objects at once.
 
 GrabCut from OpenCV can be enabled through the parameters, to process the LabelMe outlines.
+Run the main method from grabcutindexer beforehand to compute the GrabCut masks of all objects once and for all.
 
 Science of Imagination Laboratory
 
@@ -33,13 +47,19 @@ Author: Sebastien Ouellet - sebouel@gmail.com
 import os
 import sys
 import math
-import xml.dom.minidom
 import random
-from operator import itemgetter
+import time
+import tempfile
+import multiprocessing
+import itertools
+import Queue
 
 import pygame
 import xmlindexer
+import lrucache
+import masks
 import OracleScript
+import localoracle
 import numpy
 #import segmentation
 
@@ -48,6 +68,8 @@ import numpy
 # Only if OpenCV is installed. Decrease the number of iterations if too slow
 doingGrabcut = False
 grabcut_iterations = 5
+# Margin around the polygon of an object given to GrabCut as sure background, in pixels
+grabcut_margin = 20
 
 white = (255,255,255)
 black = (0,0,0)
@@ -55,18 +77,133 @@ black = (0,0,0)
 width = 1300
 height = 700
 
+# Objects wider or higher than the threshold are cut out at half their resolution
 large_threshold = 500
+# "smooth" averages pixels when pictures are scaled down, "fast" keeps one pixel out of many
+scaling_filter = "smooth"
+
+# Memory given to the objects already cut out of their pictures, in bytes
+cutout_budget = 256*1024*1024
+# Also saves the cutouts inside the data folder, so that later sessions can reuse them
+savingCutouts = False
+# Memory given to the decoded pictures of the database, in bytes
+image_budget = 256*1024*1024
+# Number of parsed annotation files kept in memory
+annotation_budget = 20000
+# Number of scenes whose objects render_scenes cuts out together when given many workers, before rendering them
+scene_batch = 64
+# Folder through which worker processes hand their cutouts back, in shared memory when the system provides one
+if os.path.isdir("/dev/shm"):
+    shared_directory = "/dev/shm"
+else:
+    shared_directory = tempfile.gettempdir()
 
 to_display = pygame.sprite.OrderedUpdates()
 current_picture = [None]
+viewer = [None]
 data_directory = xmlindexer.find_data()
 
 oracle_threshold = 0.10
+# Asks the Oracle of Objects questions to localoracle, computed from the data folder, instead of the website
+local_oracle = False
 
 ###################
 
-if doingGrabcut:
+# Only if the Python Imaging Library is installed: decodes JPEG images directly at a reduced resolution for large objects
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Only if OpenCV is installed. GrabCut masks precomputed by grabcutindexer can be used without it
+try:
     import cv2
+except ImportError:
+    cv2 = None
+
+class Index(object):
+    """ Object names and their annotation files, read once from the index file and kept in memory """
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects = None
+
+    def load(self):
+        """ Reads the index file, unless it is already in memory """
+        if self.objects is None:
+            self.objects = xmlindexer.open_index(self.directory)
+        return self.objects
+
+    def invalidate(self):
+        """ Forgets the index, so that it will be read again on the next lookup """
+        if isinstance(self.objects, xmlindexer.CompactIndex):
+            self.objects.close()
+        self.objects = None
+
+    def reload(self):
+        """ Reads the index file again, after the dataset has been indexed anew """
+        self.invalidate()
+        return self.load()
+
+    def files(self, thing):
+        """ Returns the annotation files containing the given object """
+        return self.load().get(thing, [])
+
+    def names(self):
+        """ Returns all object names, sorted """
+        return sorted(self.load())
+
+    def annotation_files(self):
+        """ Returns all annotation files listed in the index, sorted """
+        objects = self.load()
+        if isinstance(objects, xmlindexer.CompactIndex):
+            return [objects.file(number) for number in xrange(objects.file_count)]
+        return sorted(set(file for files in objects.values() for file in files))
+
+    def statistics(self, annotation):
+        """ Returns the number of objects and the labelled area of an annotation file, or None if the index doesn't record them """
+        objects = self.load()
+        if isinstance(objects, xmlindexer.CompactIndex):
+            return objects.statistics(annotation)
+        return None
+
+object_index = Index(data_directory)
+
+def cutout_size(cutout):
+    """ Returns the memory used by the mask and colours of a cutout, in bytes """
+    return cutout[0].nbytes + cutout[1].nbytes
+
+# The budgets are read from the parameters whenever the caches are used, so that they can be changed during a session
+cutouts = lrucache.LRUCache(lambda: cutout_budget, cutout_size)
+
+def image_size(image):
+    """ Returns the memory used by a decoded picture, in bytes """
+    return image.get_width()*image.get_height()*image.get_bytesize()
+
+images = lrucache.LRUCache(lambda: image_budget, image_size)
+
+class Annotation(object):
+    """ Objects of a LabelMe annotation file: their names, the vertices of their polygons and their bounding boxes """
+    def __init__(self, objects):
+        self.names = []
+        self.vertices = []
+        self.boxes = []
+        for names, vertices in objects:
+            self.names.append(names)
+            self.vertices.append(numpy.array(vertices, dtype=int).reshape(-1,2))
+            if vertices:
+                self.boxes.append(bounding_box(self.vertices[-1]))
+            else:
+                self.boxes.append(None)
+
+    def find(self, thing):
+        """ Returns the numbers of the objects of a given name """
+        return [number for number, names in enumerate(self.names) for name in names if name.strip() == thing]
+
+    def all_names(self):
+        """ Returns the names of all objects """
+        return [name for names in self.names for name in names]
+
+annotations = lrucache.LRUCache(lambda: annotation_budget, lambda annotation: 1)
 
 class Full_Picture(pygame.sprite.Sprite):
     """ Full picture taken from the LabelMe dataset """
@@ -79,15 +216,14 @@ class Full_Picture(pygame.sprite.Sprite):
 
 class Imagined(pygame.sprite.Sprite):
     """ Objects taken from the LabelMe images """
-    def __init__(self,colors,pixels,box,position):
+    def __init__(self,mask,colors,box,position):
         pygame.sprite.Sprite.__init__(self)
         self.image = pygame.Surface((box[2]-box[0],box[3]-box[1]), pygame.SRCALPHA, 32)
         self.rect = self.image.get_rect()
+        self.mask = mask
         self.colors = colors
         self.box = box
-        self.offset_pixels(pixels)
         self.image_coloring()
-        self.resize()
         self.rect.center = self.find_position(position)
         self.put_inside_frame()
 
@@ -95,31 +231,14 @@ class Imagined(pygame.sprite.Sprite):
         """ Assign a position to the object according to given values between 0 and 1, proportionally to the resolution """
         return (int(width*position[0]),int(height*position[1]))
 
-    def offset_pixels(self,pixels):
-        """ Offsets the position of the pixels so that they are adapted to the size of the object """
-        self.pixels = []
-        for pixel in pixels:
-            self.pixels.append((pixel[0]-self.box[0],pixel[1]-self.box[1]))
-
     def image_coloring(self):
         """ Colors a blank surface with the pixels found in the database image """
         imagepixels = pygame.surfarray.pixels3d(self.image)
         imagealpha = pygame.surfarray.pixels_alpha(self.image)
 
-        colors_and_pixels = zip(self.colors,self.pixels)
-        for c_and_p in colors_and_pixels:
-            imagepixels[c_and_p[1][0]][c_and_p[1][1]] = c_and_p[0]
-            imagealpha[c_and_p[1][0]][c_and_p[1][1]] = 255
-
-    def resize(self):
-        """ Scales down images larger than a threshold """
-        image_width = self.rect.right - self.rect.left
-        image_height = self.rect.bottom - self.rect.top
-
-        if image_width > large_threshold or image_height > large_threshold:
-            self.image = pygame.transform.scale(self.image, (image_width/2, image_height/2))
-
-        self.rect = self.image.get_rect()
+        mask = self.mask.array()
+        imagepixels[mask] = self.colors
+        imagealpha[mask] = 255
 
     def put_inside_frame(self):
         """ Moves the image inside the frame """
@@ -135,185 +254,225 @@ class Imagined(pygame.sprite.Sprite):
 def cut_out(thing):
     """ Withdraw an unwanted known object from a full picture  """
     vertices = get_vertices(current_picture[0].filename, thing)
-    pixels,box = inside_polygon(vertices)
-    for pixel in pixels:
-        pixel = ((pixel[0]-box[0],pixel[1]-box[1]))
+    mask,box = inside_polygon(vertices)
+    mask, colors = cut_surface(current_picture[0].image, mask, box)
+    x_pixels, y_pixels = numpy.nonzero(mask.array())
     image_pixels = pygame.surfarray.pixels3d(current_picture[0].image)
-    color = white
-    for pixel in pixels:
-        image_pixels[pixel[0]][pixel[1]] = color
+    image_pixels[x_pixels+box[0], y_pixels+box[1]] = white
     #Incomplete/Not used yet
 
 def clear():
     """ Clears the objects to be displayed """
     global to_display
     to_display.empty()
+    if viewer[0] is not None and viewer[0].alive():
+        viewer[0].sync(to_display)
 
 def xml_to_jpg(filename):
     return filename[:-4]+".jpg"
 
 def list_objects():
     """ Prints all objects in the current database """
-    index = xml.dom.minidom.parse(os.path.join(data_directory,"index.xml"))
-    for node in index.getElementsByTagName("object"):
-        for node2 in node.getElementsByTagName("name"):
-            for node3 in node2.childNodes:
-                print node3.data
+    for name in object_index.names():
+        print name
 
 def retrieve(thing, all_files=False):
     """ Retrieves from the index file the filenames for the image and the annotations """
-    index = xml.dom.minidom.parse(os.path.join(data_directory,"index.xml"))
-    files = []
-    for node in index.getElementsByTagName("object"):
-        for node2 in node.getElementsByTagName("name"):
-            for node3 in node2.childNodes:
-                if node3.data == thing:
-                    for node4 in node.getElementsByTagName("file"):
-                            for node5 in node4.childNodes:
-                                files.append(node5.data)
+    files = object_index.files(thing)
 
     if len(files) == 0:
         print "No object of that name:'"+thing+"' was found"
         return []
     else:
         if all_files:
-            return files
+            return list(files)
         else:
             annotation = random.choice(files)
             image = xml_to_jpg(annotation)
             return [annotation,image]
 
+def get_annotation(annotation):
+    """ Returns the objects of an annotation file, parsing it only if it isn't already in memory """
+    parsed = annotations.get(annotation)
+    if parsed is None:
+        parsed = Annotation(xmlindexer.parse_annotation(os.path.join(data_directory,annotation)))
+        annotations.put(annotation, parsed)
+    return parsed
+
 def get_things_from_file(annotation,thing):
-    objects = []
-    document = xml.dom.minidom.parse(os.path.join(data_directory,annotation))
-
-    for element in document.getElementsByTagName("object"):
-        for name in element.getElementsByTagName("name"):
-            for name_text in name.childNodes:
-                if name_text.data.strip() == thing:
-                    objects.append(element)
-    return objects
-
-def get_vertices(annotation,thing):
-    """ Parses the annotation file and returns all vertices for a given object, choosing randomly among the many similar objects in that scene """
-    vertices_x = []
-    vertices_y = []
-
-    element = random.choice(get_things_from_file(annotation,thing))
-
-    for polygon in element.getElementsByTagName("polygon"):
-        for point in polygon.getElementsByTagName("pt"):
-            for x in point.getElementsByTagName("x"):
-                for x_text in x.childNodes:
-                    vertices_x.append(int(x_text.data))
-            for y in point.getElementsByTagName("y"):
-                for y_text in y.childNodes:
-                    vertices_y.append(int(y_text.data))
-
-    vertices = zip(vertices_x,vertices_y)
-
-    return vertices
-
-def get_image(image_name):
-    """ Loads the image from the database in the most simple way possible """
-    image = pygame.image.load(os.path.join(data_directory,image_name))
+    """ Returns the numbers of the objects of a given name, counted in order among all objects of the annotation file """
+    return get_annotation(annotation).find(thing)
+
+def get_vertices(annotation,thing,number=None):
+    """ Returns all vertices for a given object of the annotation file, choosing randomly among the many similar objects in that scene unless its number is given """
+    parsed = get_annotation(annotation)
+    if number is None:
+        number = random.choice(parsed.find(thing))
+    return parsed.vertices[number]
+
+def decode_image(image_name, factor=1):
+    """ Decodes an image from the database, scaled down by an integer factor """
+    path = os.path.join(data_directory,image_name)
+    if factor == 1:
+        return pygame.image.load(path)
+
+    if Image is not None:
+        picture = Image.open(path)
+        size = (picture.size[0]//factor, picture.size[1]//factor)
+        # JPEG images are decoded directly at the nearest larger resolution
+        picture.draft("RGB", size)
+        picture = picture.convert("RGB")
+        if picture.size != size:
+            if scaling_filter == "smooth":
+                picture = picture.resize(size, Image.ANTIALIAS)
+            else:
+                picture = picture.resize(size, Image.NEAREST)
+        return pygame.image.fromstring(picture.tobytes(), size, "RGB")
+
+    full = get_image(image_name)
+    size = (full.get_width()//factor, full.get_height()//factor)
+    if scaling_filter == "smooth" and full.get_bitsize() >= 24:
+        return pygame.transform.smoothscale(full, size)
+    return pygame.transform.scale(full, size)
+
+def get_image(image_name, factor=1):
+    """ Loads the image from the database, scaled down by an integer factor, decoding it only if it isn't already in memory.
+    The image is shared and shouldn't be modified """
+    image = images.get((image_name, factor))
+    if image is None:
+        image = decode_image(image_name, factor)
+        images.put((image_name, factor), image)
     return image
 
+def get_image_array(image_name, region=None, factor=1):
+    """ Returns the image from the database, or a (left, top, right, bottom) region of it, as an array of rows of BGR pixels, the layout used by OpenCV """
+    pixelarray = pygame.surfarray.pixels3d(get_image(image_name, factor))
+    if region is not None:
+        pixelarray = pixelarray[region[0]:region[2],region[1]:region[3]]
+    return numpy.ascontiguousarray(pixelarray.transpose(1,0,2)[:,:,::-1])
+
 def bounding_box(vertices):
     """ Returns a box bounding the coordinates of pixels for a given polygon """
-    sorted_vertices = sorted(vertices)
-
-    x_min = sorted_vertices[0][0]
-    x_max = sorted_vertices[-1][0]
-
-    sorted_vertices = sorted(vertices,key=itemgetter(1))
-
-    y_min = sorted_vertices[0][1]
-    y_max = sorted_vertices[-1][1]
-
-    return [x_min, y_min, x_max-1, y_max-1]
-
-def grabcut_object(vertices, image_name):
-    """ Uses the GrabCut function from OpenCV 2.31 to get a better outline for an object """
-    box = bounding_box(vertices)
-    cv_image = cv2.imread(os.path.join(data_directory,image_name))
-    height, width = cv_image.shape[:2]
-    mask = numpy.zeros((height, width), dtype='uint8')
-
-    rect_width = box[2]-box[0]
-    rect_height = box[3]-box[1]
-    rect = (box[0],box[1],rect_width,rect_height)
+    vertices = numpy.asarray(vertices)
+
+    x_min, y_min = vertices.min(axis=0)
+    x_max, y_max = vertices.max(axis=0)
+
+    return [int(x_min), int(y_min), int(x_max)-1, int(y_max)-1]
+
+def scaling_factor(box):
+    """ Returns the factor by which an object is scaled down, given its bounding box """
+    if box[2]-box[0] > large_threshold or box[3]-box[1] > large_threshold:
+        return 2
+    return 1
+
+def scale_vertices(vertices, factor):
+    """ Scales down the vertices of a polygon by an integer factor """
+    return numpy.asarray(vertices)//factor
+
+def scale_mask(mask, box, factor):
+    """ Scales down a mask and its box by an integer factor, to match the box of the polygon scaled down by scale_vertices """
+    if factor == 1:
+        return mask, box
+    scaled_box = [box[0]//factor, box[1]//factor, (box[2]+1)//factor-1, (box[3]+1)//factor-1]
+    array = mask.array()
+    x_pixels = numpy.arange(scaled_box[0], scaled_box[2])*factor-box[0]
+    y_pixels = numpy.arange(scaled_box[1], scaled_box[3])*factor-box[1]
+    x_inside = (x_pixels >= 0) & (x_pixels < array.shape[0])
+    y_inside = (y_pixels >= 0) & (y_pixels < array.shape[1])
+    scaled = numpy.zeros((len(x_pixels), len(y_pixels)), dtype=bool)
+    scaled[numpy.ix_(x_inside, y_inside)] = array[numpy.ix_(x_pixels[x_inside], y_pixels[y_inside])]
+    return masks.from_array(scaled), scaled_box
+
+def grabcut_object(vertices, image_name, factor=1):
+    """ Uses the GrabCut function from OpenCV to get a better outline for an object.
+    GrabCut only sees the region around the object, seeded with its polygon: probable foreground inside, probable background around it
+    and sure background in the margin """
+    if cv2 is None:
+        raise ImportError("GrabCut needs OpenCV (cv2), which isn't installed")
+    polygon, box = inside_polygon(vertices)
+    polygon_mask = polygon.array()
+    image = get_image(image_name, factor)
+
+    # Region of interest: the bounding box and its margin, inside the picture
+    left = max(box[0]-grabcut_margin, 0)
+    top = max(box[1]-grabcut_margin, 0)
+    right = min(box[2]+grabcut_margin, image.get_width())
+    bottom = min(box[3]+grabcut_margin, image.get_height())
+
+    # Part of the bounding box inside the region of interest
+    box_left = max(box[0], left)
+    box_top = max(box[1], top)
+    box_right = max(min(box[2], right), box_left)
+    box_bottom = max(min(box[3], bottom), box_top)
+    polygon_part = polygon_mask[box_left-box[0]:box_right-box[0],box_top-box[1]:box_bottom-box[1]].T
+
+    mask = numpy.empty((max(bottom-top, 0), max(right-left, 0)), dtype=numpy.uint8)
+    mask.fill(cv2.GC_BGD)
+    mask[box_top-top:box_bottom-top,box_left-left:box_right-left] = numpy.where(polygon_part, cv2.GC_PR_FGD, cv2.GC_PR_BGD)
+
+    # GrabCut needs both foreground and background to start from
+    if not polygon_part.any() or (polygon_part.all() and mask.size == polygon_part.size):
+        return polygon, box
 
     bgd = numpy.zeros((1, 13*5))
     fgd = numpy.zeros((1, 13*5))
 
-    cv2.grabCut(cv_image, mask, rect, bgd, fgd, grabcut_iterations, mode=cv2.GC_INIT_WITH_RECT)
+    cv2.grabCut(get_image_array(image_name, (left, top, right, bottom), factor), mask, None, bgd, fgd, grabcut_iterations, mode=cv2.GC_INIT_WITH_MASK)
 
-    pixels = []
-    for y in xrange(box[1],box[3]):
-        for x in xrange(box[0],box[2]):
-            if mask[y][x] == 3:
-                pixels.append((x,y))
-    return pixels, box
+    object_mask = numpy.zeros(polygon_mask.shape, dtype=bool)
+    found = (mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD)
+    object_mask[box_left-box[0]:box_right-box[0],box_top-box[1]:box_bottom-box[1]] = found[box_top-top:box_bottom-top,box_left-left:box_right-left].T
+    return masks.from_array(object_mask), box
 
 
 def inside_polygon(vertices):
-    """ Returns a list of pixels found within a given polygon """
+    """ Returns a mask of the pixels found within a given polygon, covering its bounding box """
     # !!! There is a memory leak in the current version of Pygame, whenever a surface is created.
     box = bounding_box(vertices)
+    box_width = max(box[2]-box[0], 0)
+    box_height = max(box[3]-box[1], 0)
 
-    screen = pygame.Surface((box[2],box[3]))
+    # The polygon is drawn on a surface covering only its bounding box
+    screen = pygame.Surface((box_width,box_height))
     screen.fill(white)
-    pygame.draw.polygon(screen, black, vertices)
-    pixelscreen = pygame.surfarray.pixels2d(screen)
-    pixelarray = numpy.array(pixelscreen)
-
-    pixels = []
-    x = box[0]
-    while x < box[2]:
-        y = box[1]
-        while y < box[3]:
-            if pixelarray[x][y] == 0:
-                pixels.append((x,y))
-            y += 1
-        x += 1
-
-    return pixels,box
-
-def cut_surface(surface,pixels):
-    """ Returns the colors of the given coordinates from the given surface """
-    pixelsurface = pygame.surfarray.pixels3d(surface)
-    pixelarray = numpy.array(pixelsurface)
-
-    colors = []
-    for pixel in pixels:
-        #print pixel
-        if len(pixel) > 1:
-            #print len(pixelarray), len(pixelarray[0])
-            if len(pixelarray) > pixel[0]:
-                if len(pixelarray[pixel[0]]) > pixel[1]:
-                    colors.append(pixelarray[pixel[0]][pixel[1]])
-
-    #colors = [pixelarray[pixel[0]][pixel[1]] for pixel in pixels]
-
-    return colors
+    pygame.draw.polygon(screen, black, (numpy.asarray(vertices)-box[:2]).tolist())
+    mask = masks.from_array(pygame.surfarray.array2d(screen) == 0)
+
+    return mask,box
+
+def cut_surface(surface,mask,box):
+    """ Returns the colors of the pixels of a mask placed over a box of the given surface, along with the mask of the pixels found inside the surface """
+    pixelarray = pygame.surfarray.pixels3d(surface)
+    mask = mask.array()
+
+    # Parts of the box going past the edges of the surface are left out of the mask
+    left = max(-box[0], 0)
+    top = max(-box[1], 0)
+    right = max(min(pixelarray.shape[0]-box[0], mask.shape[0]), left)
+    bottom = max(min(pixelarray.shape[1]-box[1], mask.shape[1]), top)
+    inside = numpy.zeros(mask.shape, dtype=bool)
+    inside[left:right,top:bottom] = mask[left:right,top:bottom]
+
+    region = pixelarray[box[0]+left:box[0]+right,box[1]+top:box[1]+bottom]
+    colors = region[inside[left:right,top:bottom]]
+
+    return masks.from_array(inside), colors
 
 def find_objects(picture):
     """ Returns the objects present in the picture """
-    objects = []
-    document = xml.dom.minidom.parse(os.path.join(data_directory,picture))
-    for node_object in document.getElementsByTagName("object"):
-        for node_name in node_object.getElementsByTagName("name"):
-            for node_actualname in node_name.childNodes:
-                objects.append(node_actualname.data)
-    return objects
+    return get_annotation(picture).all_names()
 
 def fewest_picture_selection(pictures):
     """ Chooses a picture as uncluttered as possible """
     selected = ""
     minimum = 99999
     for picture in pictures:
-        number = len(find_objects(picture))
+        statistics = object_index.statistics(picture)
+        if statistics is None:
+            number = len(find_objects(picture))
+        else:
+            number = statistics[0]
         if number < minimum:
             minimum = number
             selected = picture
@@ -361,12 +520,13 @@ def find_position(angle, distance, main_position):
 
 def full_picture(thing, draw=True):
     """ Looks for a picture containing the object wanted """
-    pictures = retrieve(thing,all=True)
+    pictures = retrieve(thing,all_files=True)
     if len(pictures) == 0:
         pass
     else:
         selected = fewest_picture_selection(pictures)
-        selected_image = get_image(xml_to_jpg(selected))
+        # The picture can be modified by cut_out, so the cached image isn't used directly
+        selected_image = get_image(xml_to_jpg(selected)).copy()
         picture = Full_Picture(selected_image, selected, thing)
         to_display.add(picture)
         current_picture[0] = picture
@@ -376,7 +536,10 @@ def full_picture(thing, draw=True):
 def proximity(thing):
     """ Calls the imagine method after calling the Oracle of Object and display all objects above a threshold """
     objects = [thing]
-    oracle_answers = OracleScript.proximity(thing)
+    if local_oracle:
+        oracle_answers = localoracle.proximity(thing)
+    else:
+        oracle_answers = OracleScript.proximity(thing)
     for item in oracle_answers:
         if float(oracle_answers[item]) > oracle_threshold:
             objects.append(item)
@@ -387,24 +550,179 @@ def proximity(thing):
         imagine(item, (random.random(),random.random()), draw=False)
     draw_everything()
 
-def imagine(thing, position=(0.5,0.5), draw=True, grabcut=doingGrabcut):
-    """ Finds an appropriate image and transforms it. Display it at a given position in the format (x,y), where x and y are between 0 and 1 """
+def cutout_key(annotation, number, grabcut):
+    """ Returns the key of the cutout of an object, which tells apart the ways it can be cut out with the current parameters """
+    factor = scaling_factor(get_annotation(annotation).boxes[number])
+    scaling = None
+    if factor > 1:
+        scaling = scaling_filter
+    return annotation, number, grabcut, factor, scaling
+
+def cutout_filename(key):
+    """ Returns the path of the file in which a cutout is saved """
+    annotation, number, grabcut, factor, scaling = key
+    name = annotation[:-4]+"-"+str(number)
+    if grabcut:
+        name += "-grabcut"
+    if factor > 1:
+        name += "-"+str(factor)
+        if scaling != "smooth":
+            name += "-"+scaling
+    return os.path.join(data_directory,"cutouts",name+".npz")
+
+def save_cutout(key, cutout):
+    """ Saves a cutout inside the data folder """
+    path = cutout_filename(key)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    numpy.savez_compressed(path, runs=cutout[0].runs, shape=numpy.array(cutout[0].shape), colors=cutout[1], box=numpy.array(cutout[2]))
+
+def load_cutout(key):
+    """ Loads a cutout saved inside the data folder, or returns None if it was never saved """
+    path = cutout_filename(key)
+    if not os.path.exists(path):
+        return None
+    saved = numpy.load(path)
+    cutout = (masks.Mask(saved["runs"], saved["shape"]), saved["colors"], [int(value) for value in saved["box"]])
+    saved.close()
+    return cutout
+
+def grabcut_filename(annotation):
+    """ Returns the path of the file holding the GrabCut masks precomputed for the objects of an annotation file """
+    return os.path.join(data_directory,"grabcut",annotation[:-4]+".npz")
+
+def stored_grabcut(annotation, number):
+    """ Returns the GrabCut mask and box precomputed for an object by grabcutindexer, or None if there is none """
+    path = grabcut_filename(annotation)
+    if not os.path.exists(path):
+        return None
+    saved = numpy.load(path)
+    found = None
+    if "runs"+str(number) in saved.files:
+        mask = masks.Mask(saved["runs"+str(number)], saved["shape"+str(number)])
+        found = mask, [int(value) for value in saved["box"+str(number)]]
+    saved.close()
+    return found
+
+def extract_cutout(annotation, number, image_name, grabcut):
+    """ Cuts an object out of its picture at the resolution it will be displayed at, returning its mask, its colours and its box """
+    vertices = get_vertices(annotation,None,number)
+    factor = scaling_factor(bounding_box(vertices))
+    scaled_vertices = scale_vertices(vertices, factor)
+    image = get_image(image_name, factor)
+    found = None
+    if grabcut:
+        found = stored_grabcut(annotation, number)
+    if found is not None:
+        mask, box = scale_mask(found[0], found[1], factor)
+    elif grabcut:
+        mask, box = grabcut_object(scaled_vertices, image_name, factor)
+    else:
+        mask,box = inside_polygon(scaled_vertices)
+
+    mask, colors = cut_surface(image,mask,box)
+    return mask, colors, box
+
+def stored_cutout(key):
+    """ Returns a cutout from memory or from the data folder, or None if it was never cut out """
+    cutout = cutouts.get(key)
+    if cutout is None and savingCutouts:
+        cutout = load_cutout(key)
+        if cutout is not None:
+            cutouts.put(key, cutout)
+    return cutout
+
+def keep_cutout(key, cutout):
+    """ Keeps a new cutout in memory, and in the data folder if asked to """
+    cutouts.put(key, cutout)
+    if savingCutouts:
+        save_cutout(key, cutout)
+
+def get_cutout(annotation, number, image_name, grabcut):
+    """ Returns the cutout of an object, from memory or from the data folder when it was cut out before """
+    key = cutout_key(annotation, number, grabcut)
+    cutout = stored_cutout(key)
+    if cutout is None:
+        cutout = extract_cutout(annotation, number, image_name, grabcut)
+        keep_cutout(key, cutout)
+    return cutout
+
+def extract_cutout_job(job):
+    """ Cuts an object out of its picture inside a worker process, and hands the cutout back through a file in shared memory """
+    key, image_name, prefix = job
+    mask, colors, box = extract_cutout(key[0], key[1], image_name, key[2])
+    f = tempfile.NamedTemporaryFile(dir=shared_directory, prefix=prefix, delete=False)
+    f.write(numpy.ascontiguousarray(colors, dtype=numpy.uint8).tostring())
+    f.close()
+    # The mask is small enough to be sent back along with the name of the file
+    return key, f.name, mask, len(colors), box
+
+def receive_cutout(path, mask, length, box):
+    """ Reads back a cutout handed over by a worker process, and frees its shared memory """
+    colors = numpy.fromfile(path, dtype=numpy.uint8).reshape(length, 3)
+    os.remove(path)
+    return mask, colors, box
+
+cutout_calls = itertools.count()
+
+def get_cutouts(chosen, grabcut=doingGrabcut, workers=1, pool=None):
+    """ Returns a dictionary of the cutouts of many chosen objects, cutting out those not stored yet with a pool of processes.
+    A pool can be given to be reused between calls, otherwise one is started for the call """
+    found = {}
+    jobs = []
+    for annotation, number, image_name in chosen:
+        key = cutout_key(annotation, number, grabcut)
+        if key not in found:
+            found[key] = stored_cutout(key)
+            if found[key] is None:
+                jobs.append((key, image_name))
+
+    if (pool is not None or workers > 1) and len(jobs) > 1:
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+        # Files of this call only, so that those left unread can be found and removed if something goes wrong
+        prefix = "cutout-"+str(os.getpid())+"-"+str(next(cutout_calls))+"-"
+        finished = False
+        try:
+            for key, path, mask, length, box in pool.imap_unordered(extract_cutout_job, [(key, image_name, prefix) for key, image_name in jobs]):
+                found[key] = receive_cutout(path, mask, length, box)
+                keep_cutout(key, found[key])
+            finished = True
+        finally:
+            if own_pool or not finished:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            for name in os.listdir(shared_directory):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(shared_directory, name))
+    else:
+        for key, image_name in jobs:
+            found[key] = extract_cutout(key[0], key[1], image_name, grabcut)
+            keep_cutout(key, found[key])
+    return found
+
+def choose_object(thing):
+    """ Chooses randomly a picture and an object of the given name inside it, returns the annotation file, the object number and the image file """
     things = retrieve(thing)
     if len(things) == 0:
+        return None
+    annotation, image_name = things
+    number = random.choice(get_things_from_file(annotation,thing))
+    return annotation, number, image_name
+
+def imagine(thing, position=(0.5,0.5), draw=True, grabcut=doingGrabcut):
+    """ Finds an appropriate image and transforms it. Display it at a given position in the format (x,y), where x and y are between 0 and 1 """
+    chosen = choose_object(thing)
+    if chosen is None:
         pass
     else:
-        image_name = things[1]
-        annotation = things[0]
-        vertices = get_vertices(annotation,thing)
-        image = get_image(image_name)
-        if grabcut:
-            pixels, box = grabcut_object(vertices, image_name)
-        else:
-            pixels,box = inside_polygon(vertices)
-
-        colors = cut_surface(image,pixels)
+        mask, colors, box = get_cutout(chosen[0], chosen[1], chosen[2], grabcut)
 
-        imagined = Imagined(colors,pixels,box,position)
+        imagined = Imagined(mask,colors,box,position)
         to_display.add(imagined)
 
         print thing
@@ -412,16 +730,30 @@ def imagine(thing, position=(0.5,0.5), draw=True, grabcut=doingGrabcut):
         if draw:
             draw_everything()
 
-def display_from_file(filename):
-    """ Parses a text file to display objects """
-    main_directory = os.path.dirname(sys.argv[0])
-    f = open(os.path.join(main_directory,filename), "r")
+def imagine_many(things, workers=2, draw=True, grabcut=doingGrabcut):
+    """ Imagines many objects given as (object, position) pairs, cutting them out of their pictures in parallel processes """
+    chosen = [(choose_object(thing), position) for thing, position in things]
+    found = get_cutouts([choice for choice, position in chosen if choice is not None], grabcut, workers)
+    for choice, position in chosen:
+        if choice is not None:
+            mask, colors, box = found[cutout_key(choice[0], choice[1], grabcut)]
+            to_display.add(Imagined(mask,colors,box,position))
+
+    if draw:
+        draw_everything()
+
+def read_scene(path):
+    """ Parses a scene description file, returns its objects as (object, position) pairs """
+    things = []
+    f = open(path, "r")
     main_object = "None"
     main_position = [0.5,0.5]
     for line in f:
+        if line.strip() == "":
+            continue
         if line[0]== "#":
             main_object = line[1::].rstrip("\n")
-            imagine(main_object, main_position, draw=False)
+            things.append((main_object, main_position))
         else:
             first_index = 0
             for character in line:
@@ -443,36 +775,230 @@ def display_from_file(filename):
             angle = eval(line[first_index:second_index])
             distance = eval(line[second_index+1::])
             position = find_position(angle, distance, main_position)
-            imagine(item, position, draw=False)
+            things.append((item, position))
+    f.close()
+    return things
 
-    draw_everything()
+def compose_scene(path):
+    """ Parses a scene description file and imagines its objects, without drawing them """
+    for thing, position in read_scene(path):
+        imagine(thing, position, draw=False)
+
+def display_from_file(filename, draw=True):
+    """ Parses a text file to display objects """
+    main_directory = os.path.dirname(sys.argv[0])
+    compose_scene(os.path.join(main_directory,filename))
+    if draw:
+        draw_everything()
+
+
+def render(filename=None, as_array=False):
+    """ Composes all objects in the to_display group on an offscreen surface, without opening a window.
+    Saves it as an image if a filename is given, and returns the surface, or an array of rows of RGB pixels """
+    surface = pygame.Surface((width, height))
+    surface.fill(white)
+    to_display.draw(surface)
+
+    if filename is not None:
+        pygame.image.save(surface, filename)
+    if as_array:
+        return pygame.surfarray.array3d(surface).transpose(1,0,2)
+    return surface
+
+def render_scene_file(scene, output_directory):
+    """ Saves the objects of the to_display group as the PNG image of a scene file """
+    render(os.path.join(output_directory, os.path.splitext(os.path.basename(scene))[0]+".png"))
+
+def render_scenes(scenes, output_directory, workers=1):
+    """ Renders scene description files one after another to PNG images, without opening a window.
+    Scenes are given as a directory of scene files or as a list of their paths. Returns the time taken by each scene, in seconds.
+    With more than one worker, the objects of scene_batch scenes at a time are first cut out in parallel processes, and the times only cover composing the scenes """
+    if isinstance(scenes, basestring):
+        scenes = [os.path.join(scenes, name) for name in sorted(os.listdir(scenes)) if os.path.isfile(os.path.join(scenes, name))]
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    timings = []
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for first in xrange(0, len(scenes), scene_batch):
+                batch = scenes[first:first+scene_batch]
+                start = time.time()
+                scene_things = [[(choose_object(thing), position) for thing, position in read_scene(scene)] for scene in batch]
+                found = get_cutouts([choice for things in scene_things for choice, position in things if choice is not None], doingGrabcut, workers, pool)
+                print "Cut out "+str(len(found))+" objects in %.3f s" % (time.time()-start)
+
+                for scene, things in zip(batch, scene_things):
+                    start = time.time()
+                    clear()
+                    for choice, position in things:
+                        if choice is not None:
+                            mask, colors, box = found[cutout_key(choice[0], choice[1], doingGrabcut)]
+                            to_display.add(Imagined(mask,colors,box,position))
+                    render_scene_file(scene, output_directory)
+                    timings.append((scene, time.time()-start))
+                    print "Rendered "+scene+" in %.3f s" % timings[-1][1]
+                # The cutouts of the batch are only kept further by the cutouts cache, within its budget
+                del found, scene_things
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for scene in scenes:
+            start = time.time()
+            clear()
+            compose_scene(scene)
+            render_scene_file(scene, output_directory)
+            timings.append((scene, time.time()-start))
+            print "Rendered "+scene+" in %.3f s" % timings[-1][1]
+    clear()
+
+    print "Rendered "+str(len(timings))+" scenes in %.3f s" % sum(timing for scene, timing in timings)
+    return timings
+
+def redraw(screen, background, group, full=False):
+    """ Draws a group of sprites on the screen, updating only the areas that changed unless a full update is asked for """
+    if full:
+        screen.blit(background, (0,0))
+        group.draw(screen)
+        pygame.display.flip()
+    else:
+        group.clear(screen, background)
+        pygame.display.update(group.draw(screen))
+
+class Shown(pygame.sprite.Sprite):
+    """ Copy of a sprite, rebuilt inside the viewer process """
+    def __init__(self, data, size, rect):
+        pygame.sprite.Sprite.__init__(self)
+        self.image = pygame.image.fromstring(data, size, "RGBA")
+        self.rect = pygame.Rect(rect)
+
+def run_viewer(queue, size):
+    """ Keeps a window open inside the viewer process, showing the sprites received through the queue until it is closed """
+    pygame.init()
+    screen = pygame.display.set_mode(size,pygame.RESIZABLE)
+    pygame.display.set_caption('imagine("something")')
+    background = pygame.Surface(screen.get_size())
+    background.fill(white)
+    shown = pygame.sprite.OrderedUpdates()
+    redraw(screen, background, shown, full=True)
+
+    run = True
+    while run:
+        full = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                run = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                run = False
+            elif event.type == pygame.VIDEORESIZE:
+                screen = pygame.display.set_mode(event.size,pygame.RESIZABLE)
+                background = pygame.Surface(screen.get_size())
+                background.fill(white)
+                full = True
+            elif event.type == pygame.VIDEOEXPOSE:
+                full = True
+
+        changed = False
+        try:
+            # Waiting on the queue keeps the process asleep while nothing is sent
+            message = queue.get(timeout=0.05)
+            while True:
+                if message[0] == "add":
+                    shown.add(Shown(*message[1:]))
+                    changed = True
+                elif message[0] == "clear":
+                    shown.empty()
+                    full = True
+                elif message[0] == "quit":
+                    run = False
+                message = queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+        if run and (full or changed):
+            redraw(screen, background, shown, full)
 
+    pygame.quit()
+
+class Viewer(object):
+    """ Window kept open by a separate process, to which new sprites are sent as they are imagined """
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=run_viewer, args=(self.queue, (width, height)))
+        self.process.daemon = True
+        self.process.start()
+        self.sent = {}
+
+    def alive(self):
+        """ Tells if the window is still open """
+        return self.process.is_alive()
+
+    def sync(self, group):
+        """ Sends the sprites added to the group since the last call, or all of them again if some were removed """
+        sprites = group.sprites()
+        current = set(id(sprite) for sprite in sprites)
+        if any(sprite_id not in current for sprite_id in self.sent):
+            self.queue.put(("clear",))
+            self.sent = {}
+        for sprite in sprites:
+            if id(sprite) not in self.sent:
+                self.queue.put(("add", pygame.image.tostring(sprite.image, "RGBA"), sprite.image.get_size(), tuple(sprite.rect)))
+                # The sprite itself is kept so that its id isn't given to another sprite
+                self.sent[id(sprite)] = sprite
+
+    def close(self):
+        """ Closes the window """
+        if self.alive():
+            self.queue.put(("quit",))
+        self.process.join()
+
+def start_viewer():
+    """ Opens a window that stays open: imagine() and the other methods then return right away, and the window shows the new objects """
+    if viewer[0] is None or not viewer[0].alive():
+        viewer[0] = Viewer()
+    viewer[0].sync(to_display)
+
+def stop_viewer():
+    """ Closes the window opened by start_viewer() """
+    if viewer[0] is not None:
+        viewer[0].close()
+        viewer[0] = None
 
 def draw_everything():
     """ Display all objects in the to_display group """
 
+    # The window opened by start_viewer() only needs to be sent the new objects
+    if viewer[0] is not None and viewer[0].alive():
+        viewer[0].sync(to_display)
+        return
+
     pygame.init()
 
     screen = pygame.display.set_mode((width, height),pygame.RESIZABLE)
     pygame.display.set_caption('imagine("something")')
 
-    screen.fill(white)
+    background = pygame.Surface(screen.get_size())
+    background.fill(white)
 
-    to_display.draw(screen)
-
-    pygame.display.flip()
-
-    clock = pygame.time.Clock()
+    redraw(screen, background, to_display, full=True)
 
+    # The window sleeps until an event comes, and only repaints when it was resized or uncovered
     run = True
     while run:
-        clock.tick(60)
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                run = False
-            elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                run = False
-        to_display.draw(screen)
-        pygame.display.flip()
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            run = False
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            run = False
+        elif event.type == pygame.VIDEORESIZE:
+            screen = pygame.display.set_mode(event.size,pygame.RESIZABLE)
+            background = pygame.Surface(screen.get_size())
+            background.fill(white)
+            redraw(screen, background, to_display, full=True)
+        elif event.type == pygame.VIDEOEXPOSE:
+            redraw(screen, background, to_display, full=True)
+        # Nothing is added to the group while the window is open, so other events leave the screen as it is
 
     pygame.quit()
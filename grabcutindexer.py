@@ -0,0 +1,93 @@
+'''
+Created on 2026-10-18
+
+Computes the GrabCut outline of every indexed object beforehand, so that the display script only has to look the masks up
+
+Run the main() method after xmlindexer, from the folder containing the data folder. OpenCV needs to be installed.
+The masks of each annotation file are stored as runs of pixels inside the grabcut folder of the data folder.
+An interrupted run can be started again: annotation files whose masks are already stored, and newer than the annotation, are skipped.
+Call main(workers=N) to compute the masks with N processes.
+An annotation file whose picture is missing or can't be read is skipped and listed at the end of the run, to be tried again by the next one.
+
+Science of Imagination Laboratory
+'''
+
+import os
+import sys
+import itertools
+import multiprocessing
+
+import numpy
+import display
+
+def grabcut_annotation(annotation):
+    """ Computes the GrabCut masks of all objects of an annotation file and stores them """
+    parsed = display.get_annotation(annotation)
+    image_name = display.xml_to_jpg(annotation)
+    arrays = {}
+    for number, vertices in enumerate(parsed.vertices):
+        if len(vertices) < 3:
+            continue
+        mask, box = display.grabcut_object(vertices, image_name)
+        arrays["runs"+str(number)] = mask.runs
+        arrays["shape"+str(number)] = numpy.array(mask.shape)
+        arrays["box"+str(number)] = numpy.array(box)
+
+    # Written under another name first, so that an interrupted run never leaves an incomplete file behind
+    path = display.grabcut_filename(annotation)
+    temporary = path[:-4]+"-partial.npz"
+    numpy.savez_compressed(temporary, **arrays)
+    os.rename(temporary, path)
+    return annotation
+
+def grabcut_annotation_job(annotation):
+    """ Computes the masks of an annotation file on behalf of main, possibly inside a worker process, returning the error if it failed """
+    # A missing or unreadable picture only skips its annotation file, which is tried again by the next run
+    try:
+        grabcut_annotation(annotation)
+    except Exception, error:
+        return annotation, str(error) or error.__class__.__name__
+    return annotation, None
+
+def is_done(annotation):
+    """ Tells if the masks of an annotation file are stored and up to date """
+    path = display.grabcut_filename(annotation)
+    if not os.path.exists(path):
+        return False
+    return os.path.getmtime(path) >= os.path.getmtime(os.path.join(display.data_directory,annotation))
+
+def main(workers=1):
+    if display.cv2 is None:
+        print "OpenCV (cv2) is needed to compute GrabCut masks"
+        return
+    grabcut_directory = os.path.join(display.data_directory,"grabcut")
+    if not os.path.isdir(grabcut_directory):
+        os.makedirs(grabcut_directory)
+
+    annotations = [annotation for annotation in display.object_index.annotation_files() if not is_done(annotation)]
+    print str(len(annotations))+" annotation files to process"
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(grabcut_annotation_job, annotations)
+    else:
+        results = itertools.imap(grabcut_annotation_job, annotations)
+
+    failed = []
+    for done, (annotation, error) in enumerate(results):
+        if error is not None:
+            failed.append((annotation, error))
+        sys.stdout.write("\r"+str(done+1)+"/"+str(len(annotations))+" annotation files processed")
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if failed:
+        print str(len(failed))+" annotation files couldn't be processed:"
+        for annotation, error in failed:
+            print "   ", annotation+": "+error
+    return failed
@@ -5,6 +5,10 @@ Downloads folders from LabelMe. Run the main() method if you don't have a datase
 By default, filter out all folders with 256x256 images.
 For the number parameter, enter the number of folders you want to download or no number to download the whole database.
 For the randomized parameter, set to True if you want the script to randomly choose folders up to the number you specified in the number parameter.
+The files are downloaded by workers threads at once, over connections kept open between files. Call main(workers=N) to change their number,
+and main(rate=R) to send at most R requests per second. A file that fails to download is tried again up to retries times,
+then skipped. The files that couldn't be downloaded are listed at the end of each phase, and returned by main().
+The LabelMe website can be replaced by a copy of it, on a local server for instance, by changing the website variable.
 
 Science of Imagination Laboratory
 
@@ -14,24 +18,82 @@ Author: Sebastien Ouellet - sebouel@gmail.com
 import random
 import os
 import re
-import urllib
-import urllib2
+import sys
+import threading
 import BeautifulSoup
 
-def parse(website):
+import connections
+
+###### Variables ######
+
+website = "http://labelme.csail.mit.edu/"
+
+retries = 3
+# Seconds to wait before downloading a failed file again, doubled at each new try
+backoff = 1.0
+
+#######################
+
+def parse(pool, website):
     """ Parse a website into a tree via BeautifulSoup """
-    website_object = urllib2.Request(website)
-    website_to_parse = urllib2.urlopen(website_object)
+    website_to_parse = pool.request("GET", website)
     parsed = BeautifulSoup.BeautifulSoup(website_to_parse)
     return parsed
 
-def main(number=-1,filtering=True,randomized=False):
+def list_files(pool, website, extension):
+    """ Returns the names of the files with a given extension linked from a folder page """
+    parsed = parse(pool, website)
+    return [a.contents[0] for a in parsed.findAll('a') if a.contents[0][-3:] == extension]
+
+def download(pool, url, path):
+    """ Downloads a file, written under another name until it is complete """
+    data = pool.request("GET", url)
+    temporary = path+".part"
+    f = open(temporary, "wb")
+    f.write(data)
+    f.close()
+    os.rename(temporary, path)
+
+def download_folders(pool, data_directory, folders, kind, extension, workers):
+    """ Downloads the files of a kind (Annotations or Images) from every folder, workers at a time, and returns the errors of those that couldn't be downloaded """
+    pages = [website+kind+"/"+folder for folder in folders]
+    listings = connections.map_concurrently(lambda page: list_files(pool, page, extension), pages, workers)
+    jobs = []
+    for folder, page, names in zip(folders, pages, listings):
+        print kind+" for: ", folder, len(names), "files"
+        for name in names:
+            jobs.append((page+name, os.path.join(data_directory,folder[:-1]+"---"+name)))
+
+    done = [0]
+    failed = []
+    lock = threading.Lock()
+    def job(arguments):
+        # A file missing from the website or failing all its tries is skipped, so that the others still get downloaded
+        try:
+            download(pool, *arguments)
+        except connections.RequestError, error:
+            with lock:
+                failed.append(str(error))
+        with lock:
+            done[0] += 1
+            if done[0] % 100 == 0 or done[0] == len(jobs):
+                sys.stdout.write("\r"+str(done[0]-len(failed))+"/"+str(len(jobs))+" files downloaded")
+                sys.stdout.flush()
+    connections.map_concurrently(job, jobs, workers)
+    if jobs:
+        sys.stdout.write("\n")
+    if failed:
+        print str(len(failed))+" files couldn't be downloaded:"
+        for error in failed:
+            print "   ", error
+    return failed
+
+def main(number=-1,filtering=True,randomized=False,workers=8,rate=None):
     data_directory = "data"
     os.makedirs(data_directory)
-    
-    website = "http://labelme.csail.mit.edu/Annotations"
-    
-    parsed = parse(website)
+    pool = connections.ConnectionPool(workers, retries, backoff, rate)
+
+    parsed = parse(pool, website+"Annotations")
     folders = []
     for a in parsed.findAll('a'):
         if filtering:
@@ -44,23 +106,10 @@ def main(number=-1,filtering=True,randomized=False):
     if number == -1:
         pass
     elif randomized:
-        folders = [folders.pop(random.randint(0,len(folders)-1)) for index in xrange(number)]         
+        folders = [folders.pop(random.randint(0,len(folders)-1)) for index in xrange(number)]
     else:
         folders = folders[0:number]
-    for folder in folders:
-        print "Annotations for: ", folder
-        website = "http://labelme.csail.mit.edu/Annotations/"+folder
-        parsed = parse(website)
-        for a in parsed.findAll('a'):
-          if a.contents[0][-3:] == "xml":
-              urllib.urlretrieve(website+a.contents[0], os.path.join(data_directory,folder[:-1]+"---"+a.contents[0]))
-    for folder in folders:
-        print "Images for: ", folder
-        website = "http://labelme.csail.mit.edu/Images/"+folder
-        parsed = parse(website)
-        for a in parsed.findAll('a'):
-          if a.contents[0][-3:] == "jpg":
-              urllib.urlretrieve(website+a.contents[0], os.path.join(data_directory,folder[:-1]+"---"+a.contents[0]))
-
-    
-    
+    failed = download_folders(pool, data_directory, folders, "Annotations", "xml", workers)
+    failed += download_folders(pool, data_directory, folders, "Images", "jpg", workers)
+    pool.close()
+    return failed
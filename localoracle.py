@@ -0,0 +1,154 @@
+'''
+Created on 2026-10-18
+
+Answers the questions of the Oracle of Objects from the local LabelMe dataset, without going through the network
+
+Run the main() method from xmlindexer beforehand: it writes cooccurrence.bin, the objects found together in each image, inside the data folder.
+The functions have the same signatures as those of OracleScript, so that either module can be used:
+coocurrence1('bone','dog') returns the probability of finding a bone in an image with a dog, as a float.
+coocurrence2('bone','house','dog') and coocurrence3('bone','house','child','dog') do the same for two and three objects,
+and coocurrence(['bone','house'],'dog') for any number of objects.
+proximity('dog') returns a dictionary of object: probability of the ten objects most likely to be in an image with a dog.
+proximity_ranking('dog') returns them as a list of (object, probability) pairs, most likely first.
+
+The objects are those of the index, so that the names returned by proximity can be given to display.imagine.
+Names are looked up lowercased and stripped, and returned as written in the index, in their most frequent spelling.
+The images of each object are kept in memory as sets. The co-occurrence counts of an object with all others,
+a row of a sparse co-occurrence matrix, are computed the first time proximity asks for them and then kept.
+After indexing the data folder again, write "matrix.reload()"
+
+Science of Imagination Laboratory
+'''
+
+import os
+import heapq
+
+import xmlindexer
+
+###### Parameters ######
+
+data_directory = xmlindexer.find_data()
+
+# How many objects proximity returns
+proximity_length = 10
+
+#######################
+
+class CooccurrenceMatrix(object):
+    """ Sparse co-occurrence matrix of the object names, read from the cooccurrence file when first needed """
+    def __init__(self, data_directory):
+        self.data_directory = data_directory
+        self.images = None
+        self.rows = {}
+
+    def load(self):
+        """ Reads the objects of each image and inverts them into the set of images of each object """
+        f = open(os.path.join(self.data_directory,"cooccurrence.bin"), "rb")
+        buffer = f.read()
+        f.close()
+
+        magic, version, name_count, image_count, entry_count = xmlindexer.cooccurrence_header.unpack_from(buffer, 0)
+        if magic != xmlindexer.cooccurrence_magic or version != xmlindexer.cooccurrence_version:
+            raise ValueError(self.data_directory+" has no valid cooccurrence.bin file")
+
+        position = xmlindexer.cooccurrence_header.size
+        name_offsets = xmlindexer.read_integers(buffer, position, name_count+1)
+        position += 4*(name_count+1)
+        image_offsets = xmlindexer.read_integers(buffer, position, image_count+1)
+        position += 4*(image_count+1)
+        entries = xmlindexer.read_integers(buffer, position, entry_count)
+        position += 4*entry_count
+
+        names = [buffer[position+name_offsets[number]:position+name_offsets[number+1]].decode("utf-8") for number in xrange(name_count)]
+        # The spellings of an object differing only by case or spaces are counted as one object
+        spellings = {}
+        images = {}
+        self.objects = []
+        for image in xrange(image_count):
+            objects = set()
+            for entry in xrange(image_offsets[image], image_offsets[image+1]):
+                name = names[entries[entry]]
+                key = normalize(name)
+                spellings.setdefault(key, {})
+                spellings[key][name] = spellings[key].get(name, 0) + 1
+                objects.add(key)
+            for key in objects:
+                images.setdefault(key, []).append(image)
+            self.objects.append(list(objects))
+        self.images = dict((key, frozenset(image_numbers)) for key, image_numbers in images.iteritems())
+        self.spellings = dict((key, max(sorted(counts), key=counts.get)) for key, counts in spellings.iteritems())
+        self.rows = {}
+
+    def reload(self):
+        """ Forgets the matrix, to be read again from the data folder when next needed """
+        self.images = None
+        self.rows = {}
+
+    def images_of(self, name):
+        """ Returns the set of images containing an object """
+        if self.images is None:
+            self.load()
+        return self.images.get(normalize(name), frozenset())
+
+    def spelling(self, key):
+        """ Returns the most frequent spelling in the index of a normalized object name """
+        return self.spellings[key]
+
+    def row(self, name):
+        """ Returns the number of images in which an object is found with each other object """
+        key = normalize(name)
+        if key not in self.rows:
+            counts = {}
+            for image in self.images_of(key):
+                for other in self.objects[image]:
+                    counts[other] = counts.get(other, 0) + 1
+            self.rows[key] = counts
+        return self.rows[key]
+
+    def probability(self, facts, query):
+        """ Returns the probability of finding all the facts in an image containing the query """
+        query_images = self.images_of(query)
+        if not query_images:
+            return 0.0
+        images = query_images
+        for fact in facts:
+            images = images & self.images_of(fact)
+        return len(images)/float(len(query_images))
+
+def normalize(name):
+    """ Lowercases and strips an object name, so that its spellings in the annotations are looked up as one """
+    if isinstance(name, str):
+        name = name.decode("utf-8")
+    return name.strip().lower()
+
+matrix = CooccurrenceMatrix(data_directory)
+
+def coocurrence(facts, query):
+    """ Returns the probability of finding all the facts in an image with query, as a float """
+    return matrix.probability(facts, query)
+
+def coocurrence1(fact1, query):
+    """ Returns the probability of finding fact1 in an image with query, as a float """
+    return coocurrence([fact1], query)
+
+def coocurrence2(fact1, fact2, query):
+    """ Returns the probability of finding both fact1 and fact2 in an image with query, as a float """
+    return coocurrence([fact1, fact2], query)
+
+def coocurrence3(fact1, fact2, fact3, query):
+    """ Returns the probability of finding fact1, fact2 and fact3 in an image with query, as a float """
+    return coocurrence([fact1, fact2, fact3], query)
+
+def proximity_ranking(query):
+    """ Returns (object, probability) pairs of the objects most likely to be found in an image with query, most likely first """
+    total = len(matrix.images_of(query))
+    if total == 0:
+        return []
+    key = normalize(query)
+    counts = matrix.row(query)
+    nearest = heapq.nlargest(proximity_length, (name for name in counts if name != key), key=lambda name: (counts[name], name))
+    return [(matrix.spelling(name), counts[name]/float(total)) for name in nearest]
+
+def proximity(query):
+    """ Returns a dictionary of object: probability of the objects most likely to be found in an image with query """
+    return dict(proximity_ranking(query))
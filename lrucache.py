@@ -0,0 +1,72 @@
+'''
+Created on 2026-10-18
+
+Least recently used cache with a memory budget, used by the display script to keep what it loaded or computed.
+
+The size of each value is measured by a function given to the cache, in bytes or any other unit matching the budget.
+Once the budget is exceeded, the values used least recently are evicted first. A value larger than the whole budget is not kept.
+The budget can also be a function returning it, read each time the cache is used, so that it can be changed while the cache is in use.
+
+Science of Imagination Laboratory
+'''
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ Keeps values up to a budget, evicting the least recently used ones first """
+    def __init__(self, budget, size=len):
+        self.budget = budget
+        self.size = size
+        self.entries = OrderedDict()
+        self.used = 0
+
+    def get(self, key, default=None):
+        """ Returns the value of a key and marks it as the most recently used """
+        if key not in self.entries:
+            return default
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        # The budget may have been lowered since the values were kept
+        self.evict(self.limit())
+        return entry[0]
+
+    def limit(self):
+        """ Returns the current budget of the cache """
+        if callable(self.budget):
+            return self.budget()
+        return self.budget
+
+    def put(self, key, value):
+        """ Keeps a value, evicting older ones if the budget is exceeded """
+        if key in self.entries:
+            self.used -= self.entries.pop(key)[1]
+        budget = self.limit()
+        size = self.size(value)
+        if size > budget:
+            self.evict(budget)
+            return
+        self.entries[key] = (value, size)
+        self.used += size
+        self.evict(budget)
+
+    def evict(self, budget):
+        """ Evicts the values used least recently until the budget is met """
+        while self.used > budget:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.used -= old_entry[1]
+
+    def remove(self, key):
+        """ Forgets the value of a key, if it is kept """
+        if key in self.entries:
+            self.used -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """ Forgets all values """
+        self.entries.clear()
+        self.used = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,46 @@
+'''
+Created on 2026-10-18
+
+Compact masks of the objects cut out of the LabelMe images
+
+A mask covers the bounding box of an object, indexed by x and y like the surfaces of Pygame.
+Instead of one boolean per pixel, it keeps the boundaries of the runs of pixels belonging to the object, in the order of the flattened box.
+Outlines drawn from polygons have a couple of runs per column, so a mask takes a few bytes per column instead of one byte per pixel.
+
+Science of Imagination Laboratory
+'''
+
+import numpy
+
+class Mask(object):
+    """ Boolean mask over the bounding box of an object, kept as the start and end of each run of pixels """
+    def __init__(self, runs, shape):
+        self.runs = numpy.asarray(runs, dtype=numpy.uint32)
+        self.shape = tuple(int(length) for length in shape)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the runs, in bytes """
+        return self.runs.nbytes
+
+    def array(self):
+        """ Returns the mask as an array of booleans """
+        size = self.shape[0]*self.shape[1]
+        boundaries = numpy.concatenate(([0], self.runs, [size])).astype(numpy.int64)
+        values = numpy.arange(len(boundaries)-1) % 2 == 1
+        return numpy.repeat(values, numpy.diff(boundaries)).reshape(self.shape)
+
+    def count(self):
+        """ Returns the number of pixels in the mask """
+        runs = self.runs.astype(numpy.int64)
+        return int((runs[1::2]-runs[0::2]).sum())
+
+    def any(self):
+        """ Tells if the mask has any pixel """
+        return len(self.runs) > 0
+
+def from_array(array):
+    """ Returns the mask of an array of booleans """
+    flat = numpy.ascontiguousarray(array, dtype=bool).ravel()
+    padded = numpy.concatenate(([False], flat, [False]))
+    return Mask(numpy.flatnonzero(padded[1:] != padded[:-1]), array.shape)
@@ -5,6 +5,11 @@ Parses annotations files and creates a XML index file of objects and their locat
 
 Once you have a dataset from LabelMe (got through labelmeretriever or otherwise),
 run the main() method from the folder containing the data folder to generate an index file inside the data folder
+The index is written in a compact binary format (index.bin). Call main(xml_export=True) to also write the older index.xml.
+Annotation files are streamed through in a single pass. Call main(streaming=False) to parse them as DOM trees instead.
+Call main(workers=N) to read the annotation files with N processes.
+Call main(incremental=True) to read only the annotation files added or modified since the last indexing, as listed in index_manifest.json.
+The objects found together in each image are also written to cooccurrence.bin, from which localoracle answers co-occurrence questions.
 By default, will filter out images smaller than 6000 pixels. Easy to change with the small_area variable at the top of the script.
 The area of the images filtered out will be half the area specified in the variable.
 
@@ -17,14 +22,41 @@ import math
 import os
 import sys
 import re
+import mmap
+import struct
+import array
+import itertools
+import hashlib
+import json
+import multiprocessing
 import xml.dom.minidom
+import xml.etree.cElementTree as ElementTree
 
 ###### Variable ######
 
 small_area = 12000.0
 
+# How many annotation files are read between two updates of the progress counter
+progress_step = 1000
+
 #######################
 
+index_magic = "VIDX"
+index_version = 2
+# Magic, version, number of names, number of files, number of (name, file) entries
+index_header = struct.Struct("<4sIIII")
+
+cooccurrence_magic = "VCOC"
+cooccurrence_version = 1
+# Magic, version, number of names, number of images, number of (image, name) entries
+cooccurrence_header = struct.Struct("<4sIIII")
+
+# The compact index stores its tables as little-endian 32 bits unsigned integers
+if array.array("I").itemsize == 4:
+    integer_code = "I"
+else:
+    integer_code = "L"
+
 def find_data(further=False):
     """ Provides the path to the data directory  """
     main_directory = os.path.dirname(sys.argv[0])
@@ -66,28 +98,401 @@ def create_index(data_directory, list_objects):
     f.write(to_print.encode('utf-8'))
     f.close()
     
-def find_annotations(data_directory, filtering):
-    """ Parses the XML annotation files for object names and file names and filters out small images """
+def write_integers(f, integers, code=integer_code):
+    """ Writes a table of integers, or of floats with the "f" code, to a compact index file """
+    table = array.array(code, integers)
+    if sys.byteorder != "little":
+        table.byteswap()
+    f.write(table.tostring())
+
+def read_integers(buffer, position, length, code=integer_code):
+    """ Reads a table of integers, or of floats with the "f" code, from a compact index file """
+    table = array.array(code)
+    table.fromstring(buffer[position:position+4*length])
+    if sys.byteorder != "little":
+        table.byteswap()
+    return table
+
+def string_table(strings):
+    """ Joins strings into a single block of UTF-8 text, with the offsets delimiting each string """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = [0]
+    for string in encoded:
+        offsets.append(offsets[-1]+len(string))
+    return "".join(encoded), offsets
+
+def create_compact_index(data_directory, list_objects, statistics=None):
+    """ Writes a compact binary index file: sorted tables of unique object names and file names, the file numbers of each object and the statistics of each file """
+    if statistics is None:
+        statistics = {}
+    files = sorted(set(location for old_object in list_objects for location in old_object[1]))
+    file_numbers = dict((location, number) for number, location in enumerate(files))
+    list_objects = sorted(list_objects)
+
+    entries = []
+    entry_offsets = [0]
+    for old_object in list_objects:
+        entries.extend(file_numbers[location] for location in old_object[1])
+        entry_offsets.append(len(entries))
+
+    names, name_offsets = string_table([old_object[0] for old_object in list_objects])
+    file_names, file_offsets = string_table(files)
+    object_counts = [statistics.get(location, (0, 0.0))[0] for location in files]
+    labelled_areas = [statistics.get(location, (0, 0.0))[1] for location in files]
+
+    # Written under another name first and then renamed, so that a session still mapping the old index keeps reading it whole
+    path = os.path.join(data_directory,"index.bin")
+    f = open(path+".tmp", "wb")
+    f.write(index_header.pack(index_magic, index_version, len(list_objects), len(files), len(entries)))
+    write_integers(f, name_offsets)
+    write_integers(f, file_offsets)
+    write_integers(f, entry_offsets)
+    write_integers(f, entries)
+    write_integers(f, object_counts)
+    write_integers(f, labelled_areas, "f")
+    f.write(names)
+    f.write(file_names)
+    f.close()
+    os.rename(path+".tmp", path)
+
+def image_objects(annotations, filtering=True):
+    """ Returns the set of object names found in each annotation file, written and filtered as in the index """
     objects = []
-    list_files = os.listdir(data_directory)
-    for file in list_files:
-        if file[-3:] == "xml":
-            try:
-                document = xml.dom.minidom.parse(os.path.join(data_directory,file))            
-                for node_object in document.getElementsByTagName("object"):
-                    for node_name in node_object.getElementsByTagName("name"):
-                        for node_actualname in node_name.childNodes:
-                            if filtering:
-                                if areafilter(node_object):
-                                    objects.append([node_actualname.data,file])
-                            else:
-                                objects.append([node_actualname.data,file])
-            except xml.parsers.expat.ExpatError:
-                print ""+file+" is empty"
+    for file in sorted(annotations):
+        annotation = annotations[file]
+        if annotation:
+            objects.append(set(name for name, area in annotation if not filtering or area > small_area))
     return objects
 
+def create_cooccurrence_file(data_directory, annotations, filtering=True):
+    """ Writes the objects of each image as a sorted table of unique object names and the name numbers found in each image """
+    objects = image_objects(annotations, filtering)
+    names = sorted(set(name for image in objects for name in image))
+    name_numbers = dict((name, number) for number, name in enumerate(names))
+
+    entries = []
+    image_offsets = [0]
+    for image in objects:
+        entries.extend(sorted(name_numbers[name] for name in image))
+        image_offsets.append(len(entries))
+
+    name_block, name_offsets = string_table(names)
+
+    # Written under another name first and then renamed, like the index
+    path = os.path.join(data_directory,"cooccurrence.bin")
+    f = open(path+".tmp", "wb")
+    f.write(cooccurrence_header.pack(cooccurrence_magic, cooccurrence_version, len(names), len(objects), len(entries)))
+    write_integers(f, name_offsets)
+    write_integers(f, image_offsets)
+    write_integers(f, entries)
+    f.write(name_block)
+    f.close()
+    os.rename(path+".tmp", path)
+
+class CompactIndex(object):
+    """ Read-only view of a compact index file, mapped in memory and decoded only where it is looked up """
+    def __init__(self, path):
+        f = open(path, "rb")
+        self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+        magic, version, self.name_count, self.file_count, entry_count = index_header.unpack_from(self.buffer, 0)
+        if magic != index_magic or version != index_version:
+            raise ValueError(path+" is not a compact index file")
+
+        position = index_header.size
+        self.name_offsets = read_integers(self.buffer, position, self.name_count+1)
+        position += 4*(self.name_count+1)
+        self.file_offsets = read_integers(self.buffer, position, self.file_count+1)
+        position += 4*(self.file_count+1)
+        self.entry_offsets = read_integers(self.buffer, position, self.name_count+1)
+        position += 4*(self.name_count+1)
+        self.entries = read_integers(self.buffer, position, entry_count)
+        position += 4*entry_count
+        self.object_counts = read_integers(self.buffer, position, self.file_count)
+        position += 4*self.file_count
+        self.labelled_areas = read_integers(self.buffer, position, self.file_count, "f")
+        position += 4*self.file_count
+        self.names_position = position
+        self.files_position = position + self.name_offsets[-1]
+
+    def name(self, number):
+        """ Returns the object name stored at a given position of the sorted name table """
+        start = self.names_position + self.name_offsets[number]
+        end = self.names_position + self.name_offsets[number+1]
+        return self.buffer[start:end].decode("utf-8")
+
+    def file(self, number):
+        """ Returns the file name of a given file number """
+        start = self.files_position + self.file_offsets[number]
+        end = self.files_position + self.file_offsets[number+1]
+        return self.buffer[start:end].decode("utf-8")
+
+    def search(self, table, length, value):
+        """ Binary search of a string in a sorted table of the index, returns its position or -1 """
+        if isinstance(value, str):
+            value = value.decode("utf-8")
+        low = 0
+        high = length
+        while low < high:
+            middle = (low+high)//2
+            if table(middle) < value:
+                low = middle+1
+            else:
+                high = middle
+        if low < length and table(low) == value:
+            return low
+        return -1
+
+    def find(self, thing):
+        """ Returns the position of an object name in the sorted name table, or -1 """
+        return self.search(self.name, self.name_count, thing)
+
+    def statistics(self, location):
+        """ Returns the number of objects and the labelled area of an annotation file, or None if it isn't indexed """
+        number = self.search(self.file, self.file_count, location)
+        if number == -1:
+            return None
+        return int(self.object_counts[number]), self.labelled_areas[number]
+
+    def get(self, thing, default=None):
+        """ Returns the annotation files containing the given object """
+        number = self.find(thing)
+        if number == -1:
+            return default
+        entries = self.entries[self.entry_offsets[number]:self.entry_offsets[number+1]]
+        return [self.file(file_number) for file_number in entries]
+
+    def __contains__(self, thing):
+        return self.find(thing) != -1
+
+    def __iter__(self):
+        for number in xrange(self.name_count):
+            yield self.name(number)
+
+    def __len__(self):
+        return self.name_count
+
+    def close(self):
+        self.buffer.close()
+
+def open_index(data_directory):
+    """ Opens the compact index of the data directory, or reads the XML index if there is no compact index """
+    path = os.path.join(data_directory,"index.bin")
+    if os.path.exists(path):
+        return CompactIndex(path)
+    return read_index(data_directory)
+
+def read_index(data_directory):
+    """ Reads the XML index file into a dictionary of object names pointing to their annotation files """
+    objects = {}
+    document = xml.dom.minidom.parse(os.path.join(data_directory,"index.xml"))
+    for node_object in document.getElementsByTagName("object"):
+        files = []
+        for node_file in node_object.getElementsByTagName("file"):
+            for node_actualfile in node_file.childNodes:
+                files.append(node_actualfile.data)
+        for node_name in node_object.getElementsByTagName("name"):
+            for node_actualname in node_name.childNodes:
+                objects.setdefault(node_actualname.data, []).extend(files)
+    return objects
+
+def annotation_files(data_directory):
+    """ Lists the XML annotation files of the data directory, leaving out the index """
+    return [file for file in os.listdir(data_directory) if file[-3:] == "xml" and file != "index.xml"]
+
+def parse_annotation(path):
+    """ Streams through an annotation file in a single pass, returning the names and the polygon vertices of each object """
+    objects = []
+    names = []
+    vertices = []
+    point = {}
+    depth = 0
+    root = None
+    for event, element in ElementTree.iterparse(path, events=("start","end")):
+        if root is None:
+            root = element
+        if element.tag == "object":
+            if event == "start":
+                depth += 1
+            else:
+                depth -= 1
+                objects.append((names, vertices))
+                names = []
+                vertices = []
+                # Objects already read are dropped, so that memory stays bounded on large files
+                root.clear()
+        elif event == "end" and depth > 0:
+            if element.tag == "name":
+                if element.text:
+                    names.append(element.text)
+            elif element.tag == "x" or element.tag == "y":
+                if element.text:
+                    point[element.tag] = int(float(element.text))
+            elif element.tag == "pt":
+                if "x" in point and "y" in point:
+                    vertices.append((point["x"],point["y"]))
+                point = {}
+    return objects
+
+def read_annotation(data_directory, file, streaming=True):
+    """ Returns the name and the area of each object of an annotation file, or None if the file can't be parsed """
+    objects = []
+    path = os.path.join(data_directory,file)
+    if streaming:
+        try:
+            for names, vertices in parse_annotation(path):
+                area = compute_area(vertices)
+                for name in names:
+                    objects.append((name, area))
+        except ElementTree.ParseError:
+            return None
+    else:
+        try:
+            document = xml.dom.minidom.parse(path)
+        except xml.parsers.expat.ExpatError:
+            return None
+        for node_object in document.getElementsByTagName("object"):
+            area = object_area(node_object)
+            for node_name in node_object.getElementsByTagName("name"):
+                for node_actualname in node_name.childNodes:
+                    objects.append((node_actualname.data, area))
+    return objects
+
+def read_annotation_job(job):
+    """ Reads an annotation file on behalf of read_annotations, possibly inside a worker process, along with its digest if asked for """
+    data_directory, file, streaming, hashing = job
+    digest = None
+    if hashing:
+        digest = file_hash(os.path.join(data_directory,file))
+    return file, read_annotation(data_directory, file, streaming), digest
+
+def report_progress(done, total):
+    """ Updates the progress counter of the annotation files read so far """
+    if done % progress_step == 0 or done == total:
+        sys.stdout.write("\r"+str(done)+"/"+str(total)+" annotation files read")
+        if done == total:
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+def read_annotations(data_directory, files, streaming=True, workers=1, digests=None):
+    """ Reads many annotation files, spread over a pool of processes when more than one worker is asked for.
+    If a dictionary of digests is given, the MD5 digest of each file is computed along with its reading and stored in it """
+    jobs = [(data_directory, file, streaming, digests is not None) for file in files]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        chunk = max(1, len(jobs)//(workers*16))
+        results = pool.imap_unordered(read_annotation_job, jobs, chunk)
+    else:
+        results = itertools.imap(read_annotation_job, jobs)
+
+    annotations = {}
+    for file, annotation, digest in results:
+        annotations[file] = annotation
+        if digests is not None:
+            digests[file] = digest
+        report_progress(len(annotations), len(jobs))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return annotations
+
+def file_hash(path):
+    """ Returns the MD5 digest of a file """
+    digest = hashlib.md5()
+    f = open(path, "rb")
+    for block in iter(lambda: f.read(65536), ""):
+        digest.update(block)
+    f.close()
+    return digest.hexdigest()
+
+def read_manifest(data_directory):
+    """ Reads the manifest of the annotation files indexed so far, or returns an empty manifest """
+    path = os.path.join(data_directory,"index_manifest.json")
+    if not os.path.exists(path):
+        return {}
+    f = open(path, "r")
+    manifest = json.load(f)
+    f.close()
+    return manifest
+
+def write_manifest(data_directory, manifest):
+    """ Writes the manifest of the annotation files: their modification time, size, hash and objects """
+    f = open(os.path.join(data_directory,"index_manifest.json"), "w")
+    json.dump(manifest, f)
+    f.close()
+
+def update_annotations(data_directory, streaming=True, workers=1, incremental=True):
+    """ Reads the annotation files added or modified since the last manifest, reuses the others, and writes the manifest anew """
+    if incremental:
+        manifest = read_manifest(data_directory)
+    else:
+        manifest = {}
+
+    updated = {}
+    to_read = []
+    for file in annotation_files(data_directory):
+        path = os.path.join(data_directory,file)
+        status = os.stat(path)
+        entry = manifest.get(file)
+        if entry is not None and entry["mtime"] == status.st_mtime and entry["size"] == status.st_size:
+            updated[file] = entry
+            continue
+        # Only a file touched without changing its size could still be the same: its digest tells
+        if entry is not None and entry["size"] == status.st_size and entry["hash"] == file_hash(path):
+            entry["mtime"] = status.st_mtime
+            updated[file] = entry
+            continue
+        updated[file] = {"mtime": status.st_mtime, "size": status.st_size, "hash": None, "objects": None}
+        to_read.append(file)
+
+    if incremental:
+        print str(len(to_read))+" annotation files added or modified, "+str(len(set(manifest)-set(updated)))+" removed"
+    digests = {}
+    for file, annotation in read_annotations(data_directory, to_read, streaming, workers, digests).iteritems():
+        updated[file]["objects"] = annotation
+        updated[file]["hash"] = digests[file]
+
+    write_manifest(data_directory, updated)
+    return dict((file, updated[file]["objects"]) for file in updated)
+
+def picture_statistics(annotations):
+    """ Counts the objects of each annotation file and sums up their area, small objects included """
+    statistics = {}
+    for file, annotation in annotations.iteritems():
+        if annotation is not None:
+            statistics[file] = (len(annotation), sum(area for name, area in annotation))
+    return statistics
+
+def select_objects(annotations, filtering):
+    """ Pairs object names with the file they are found in, filtering out small images """
+    objects = []
+    for file in sorted(annotations):
+        annotation = annotations[file]
+        if annotation is None:
+            print ""+file+" is empty"
+            continue
+        for name, area in annotation:
+            if not filtering or area > small_area:
+                objects.append([name,file])
+    return objects
+
+def find_annotations(data_directory, filtering, streaming=True, workers=1):
+    """ Parses the XML annotation files for object names and file names and filters out small images """
+    annotations = read_annotations(data_directory, annotation_files(data_directory), streaming, workers)
+    return select_objects(annotations, filtering)
+
 def areafilter(node_object):
     """ Calculates the area of an image and decides if it's too small """
+    if object_area(node_object) > small_area:
+        return True
+    else:
+        return False
+
+def object_area(node_object):
+    """ Calculates the area of the polygon of an object node """
     vertices_x = []
     vertices_y = []
 
@@ -102,11 +507,7 @@ def areafilter(node_object):
 
     vertices = zip(vertices_x,vertices_y)
 
-    area = compute_area(vertices)    
-    if area > small_area:
-        return True
-    else:
-        return False
+    return compute_area(vertices)
 
 def compute_area(vertices):
     """ Compute the area of a polygon given its vertices """
@@ -134,8 +535,12 @@ def sort_annotations(objects):
             
     return sorted_list    
 
-def main(filtering=True):
+def main(filtering=True, xml_export=False, streaming=True, workers=1, incremental=False):
     data_directory = find_data()
-    objects = find_annotations(data_directory,filtering)
+    annotations = update_annotations(data_directory,streaming,workers,incremental)
+    objects = select_objects(annotations,filtering)
     objects = sort_annotations(objects)
-    create_index(data_directory, objects)
+    create_compact_index(data_directory, objects, picture_statistics(annotations))
+    create_cooccurrence_file(data_directory, annotations, filtering)
+    if xml_export:
+        create_index(data_directory, objects)